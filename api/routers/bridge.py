@@ -118,7 +118,7 @@ class BridgeRouter:  # pylint: disable=too-few-public-methods
 
                 locker = asyncio.Lock()
                 await locker.acquire()
-                event_loop.create_task(run_controller(self.dispatcher, event_loop, True, False, False))
+                event_loop.create_task(run_controller(self.dispatcher, True, False, False))
                 locker.release()
 
                 return BridgeResponseSchema(bridge=BridgeResponse(
@@ -1,16 +1,40 @@
 """Configuration handler."""
 from __future__ import annotations
 
+import copy
+import functools
 import os
 import sys
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, FrozenSet, List, Tuple
 
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader  # type: ignore
+
+# Parsed and validated configuration data, keyed by file path and
+# holding the modification time of the file it was read from.
+_parsed_cache: Dict[str, Tuple[int, Any]] = {}
+
+# The top-level sections every configuration file must define.
+REQUIRED_KEYS: FrozenSet[str] = frozenset({
+    "application",
+    "logger",
+    "telegram",
+    "discord",
+    "telegram_forwarders",
+})
+
 
 class AppConfig():  # pylint: disable=too-few-public-methods
     """Application configuration handler."""
 
+    __slots__ = ("name", "version", "description", "debug", "internet_connected",
+                 "healthcheck_interval", "recoverer_delay", "history_size_limit",
+                 "messagesdb_filename", "backfill_limit")
+
     def __init__(self, config_data):
         self.name: str = config_data["name"]
         self.version: str = config_data["version"]
@@ -21,11 +45,16 @@ class AppConfig():  # pylint: disable=too-few-public-methods
         self.recoverer_delay: float = config_data["recoverer_delay"]
         self.history_size_limit: float = config_data["history_size_limit"]
         self.messagesdb_filename: float = config_data["messagesdb_filename"]
+        # The maximum number of missed messages fetched per forwarder, None for no limit.
+        self.backfill_limit: int | None = config_data.get("backfill_limit")
 
 
 class APIConfig():  # pylint: disable=too-few-public-methods
     """API configuration handler."""
 
+    __slots__ = ("enabled", "cors_origins", "telegram_login_enabled", "telegram_auth_file",
+                 "telegram_auth_request_expiration")
+
     def __init__(self, config_data):
         self.enabled = config_data["enabled"]
         self.cors_origins: List[str] = config_data["cors_origins"]
@@ -37,6 +66,8 @@ class APIConfig():  # pylint: disable=too-few-public-methods
 class LoggerConfig():  # pylint: disable=too-few-public-methods
     """Logger configuration handler."""
 
+    __slots__ = ("level", "file_max_bytes", "file_backup_count", "format", "date_format", "console")
+
     def __init__(self, config_data):
         self.level = config_data["level"]
         self.file_max_bytes = config_data["file_max_bytes"]
@@ -49,6 +80,8 @@ class LoggerConfig():  # pylint: disable=too-few-public-methods
 class TelegramConfig():  # pylint: disable=too-few-public-methods
     """Telegram configuration handler."""
 
+    __slots__ = ("is_healthy", "phone", "password", "api_id", "api_hash", "log_unhandled_conversations")
+
     def __init__(self, config_data):
         self.is_healthy: bool = False
         self.phone = config_data["phone"]
@@ -61,6 +94,8 @@ class TelegramConfig():  # pylint: disable=too-few-public-methods
 class DiscordConfig():  # pylint: disable=too-few-public-methods
     """Discord configuration handler."""
 
+    __slots__ = ("is_healthy", "bot_token", "built_in_roles", "max_latency")
+
     def __init__(self, config_data):
         self.is_healthy: bool = False
         self.bot_token: str = config_data["bot_token"]
@@ -71,6 +106,9 @@ class DiscordConfig():  # pylint: disable=too-few-public-methods
 class OpenAIConfig():  # pylint: disable=too-few-public-methods
     """OpenAI configuration handler."""
 
+    __slots__ = ("is_healthy", "filter", "model", "temperature", "api_key", "organization",
+                 "enabled", "sentiment_analysis_prompt")
+
     def __getitem__(self, key: str) -> str:
         return getattr(self, key)
 
@@ -88,80 +126,114 @@ class OpenAIConfig():  # pylint: disable=too-few-public-methods
 class Config:  # pylint: disable=too-many-instance-attributes
     """Configuration handler."""
 
-    _instances: Dict[str, 'Config'] = {}
-    _file_path = os.path.join(
-        os.path.curdir,
-        "config.yml",
-    )
-
-    def __new__(cls):
-        """Creates a new Config instance."""
-        if None not in cls._instances:
-            instance = super().__new__(cls)
-            instance._initialized = False
-            cls._instances[""] = instance
-        return cls._instances[""]
-
-    def __init__(self):
-        """Initializes a new Config instance."""
-        if not self._initialized:
-            self._initialized = True
+    _default: Config | None = None
 
-            self.app: AppConfig
-            self.api: APIConfig
-            self.logger: LoggerConfig
-            self.telegram: TelegramConfig
-            self.discord: DiscordConfig
-            self.openai: OpenAIConfig
-            self.telegram_forwarders = []
+    def __new__(cls, file_path: str | None = None):
+        """Creates a new Config instance for the given file, or returns the
+        default configuration."""
+        if file_path is not None:
+            return super().__new__(cls)
+        if cls._default is None:
+            cls._default = cls.load_for()
+        return cls._default
 
-            self.load()
+    def __init__(self, file_path: str | None = None):
+        """Initializes a new Config instance."""
+        if file_path is None:
+            # The default configuration was already initialized by load_for.
+            return
+
+        self._file_path = file_path
+
+        self.app: AppConfig
+        self.api: APIConfig
+        self.logger: LoggerConfig
+        self.telegram: TelegramConfig
+        self.discord: DiscordConfig
+        self.openai: OpenAIConfig
+        self.telegram_forwarders = []
+        self._forwarder_by_name: Dict[str, dict] = {}
+        self._forwarders_by_tg_channel: Dict[Any, List[dict]] = {}
+        self._forward_hashtag_names: Dict[str, FrozenSet[str]] = {}
+        self._excluded_hashtag_names: Dict[str, FrozenSet[str]] = {}
+
+        self.load()
 
-    def set_file_path(self, version: str):
-        """Set the file path based on the version."""
+    @staticmethod
+    def get_file_path(version: str | None = "") -> str:
+        """Get the configuration file path based on the version."""
         if version:
-            self._file_path = os.path.join(
-                os.path.curdir,
-                f"config-{version}.yml",
-            )
-        else:
-            self._file_path = os.path.join(
-                os.path.curdir,
-                "config.yml",
-            )
-
-    def set_version(self, version: str):
-        """Set the version of the configuration."""
-        if version not in Config._instances:
-            Config._instances[version] = Config()
-        Config._instances[version].set_file_path(version)
-        Config._instances[version].load()
-        return Config._instances[version]
+            return os.path.join(os.path.curdir, f"config-{version}.yml")
+        return os.path.join(os.path.curdir, "config.yml")
 
     @staticmethod
-    def get_config_instance(version: str | None = "") -> 'Config':
-        """Get the configuration instance based on the version."""
+    def load_for(version: str | None = "") -> Config:
+        """Get the configuration for the given version, loaded again only
+        when its file has been modified."""
+        file_path = Config.get_file_path(version)
         try:
-            return Config._instances[version] if version and version in Config._instances else Config._instances[""]
-        except KeyError as ex:
-            raise ValueError(f'Invalid version: {version}') from ex
+            mtime = os.stat(file_path).st_mtime_ns
+        except FileNotFoundError:
+            print("Error: Configuration file not found.")
+            sys.exit(1)
+        return _load_config(file_path, mtime)
 
-    # Set the configuration instance based on the version.
     @staticmethod
-    def set_config_instance(config: 'Config', version: str | None = "") -> Config:
-        """Set the configuration instance based on the version."""
-        if not version:
-            version = ""
-        if version not in Config._instances:
-            print("Setting config instance for version %s", version)
-            Config._instances[version] = config
-        return config
+    def get_config_instance(version: str | None = "") -> Config:
+        """Get the configuration instance based on the version."""
+        if version:
+            return Config.load_for(version)
+        return Config()
 
     def load(self) -> Any:
         """Load configuration from the 'config-{version}.yml' file."""
+        config_data = copy.deepcopy(Config.read_config_data(self._file_path))
+
+        self.app = AppConfig(config_data["application"])
+        self.api = APIConfig(config_data["api"])
+        self.logger = LoggerConfig(config_data["logger"])
+        self.telegram = TelegramConfig(config_data["telegram"])
+        self.discord = DiscordConfig(config_data["discord"])
+        self.openai = OpenAIConfig(config_data["openai"])
+
+        self.telegram_forwarders = config_data["telegram_forwarders"]
+        self.index_forwarders()
+
+        return config_data
+
+    def index_forwarders(self):
+        """Build the forwarders lookup tables used while dispatching messages."""
+        self._forwarder_by_name = {}
+        self._forwarders_by_tg_channel = {}
+        self._forward_hashtag_names = {}
+        self._excluded_hashtag_names = {}
+
+        for forwarder in self.telegram_forwarders:
+            # Forwarder names are the keys of every per-forwarder lookup, intern them.
+            forwarder_name = forwarder["forwarder_name"] = sys.intern(forwarder["forwarder_name"])
+            self._forwarders_by_tg_channel.setdefault(
+                forwarder["tg_channel_id"], []).append(forwarder)
+            # validate_config rejects duplicate names, the first forwarder wins in every per-name table otherwise.
+            if forwarder_name in self._forwarder_by_name:
+                continue
+            self._forwarder_by_name[forwarder_name] = forwarder
+            self._forward_hashtag_names[forwarder_name] = Config.get_hashtag_names(
+                Config.get_forward_hashtags(forwarder))
+            self._excluded_hashtag_names[forwarder_name] = Config.get_hashtag_names(
+                Config.get_excluded_hashtags(forwarder))
+
+    @staticmethod
+    def read_config_data(file_path: str) -> Any:
+        """Read and validate the configuration data, reusing the cached
+        result as long as the file has not been modified."""
         try:
-            with open(self._file_path, 'rb') as config_file:
-                config_data = yaml.safe_load(config_file)
+            mtime = os.stat(file_path).st_mtime_ns
+            cached = _parsed_cache.get(file_path)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+
+            with open(file_path, 'rb') as config_file:
+                config_data = yaml.load(config_file, Loader=SafeLoader)
         except FileNotFoundError:
             print("Error: Configuration file not found.")
             sys.exit(1)
@@ -169,19 +241,11 @@ class Config:  # pylint: disable=too-many-instance-attributes
             print("Error parsing configuration file: %s", ex)
             sys.exit(1)
 
-        required_keys = [
-            "application",
-            "logger",
-            "telegram",
-            "discord",
-            "telegram_forwarders",
-        ]
-
-        for key in required_keys:
-            if key not in config_data:
-                print(
-                    "Error: Key %s not found in the configuration file.", key)
-                sys.exit(1)
+        missing_keys = REQUIRED_KEYS.difference(config_data)
+        if missing_keys:
+            print(
+                f"Error: Keys {', '.join(sorted(missing_keys))} not found in the configuration file.")
+            sys.exit(1)
 
         valid, errors = Config.validate_config(config_data)
 
@@ -191,14 +255,8 @@ class Config:  # pylint: disable=too-many-instance-attributes
                 print(f"\n{error}\n")
             sys.exit(1)
 
-        self.app = AppConfig(config_data["application"])
-        self.api = APIConfig(config_data["api"])
-        self.logger = LoggerConfig(config_data["logger"])
-        self.telegram = TelegramConfig(config_data["telegram"])
-        self.discord = DiscordConfig(config_data["discord"])
-        self.openai = OpenAIConfig(config_data["openai"])
-
-        self.telegram_forwarders = config_data["telegram_forwarders"]
+        # Only valid configurations are cached, so a cache hit skips validation as well.
+        _parsed_cache[file_path] = (mtime, config_data)
 
         return config_data
 
@@ -225,6 +283,16 @@ class Config:  # pylint: disable=too-many-instance-attributes
 
         return True, ""
 
+    @staticmethod
+    def validate_forwarder_name(forwarder, forwarder_names) -> Tuple[bool, str]:
+        """Check for unique forwarder_name, the per-forwarder lookups and the history are keyed by it"""
+        forwarder_name = forwarder["forwarder_name"]
+        if forwarder_name in forwarder_names:
+            return False, f"Invalid configuration: duplicate forwarder_name {forwarder_name}"
+
+        forwarder_names.add(forwarder_name)
+        return True, ""
+
     @ staticmethod
     def validate_forwarder_combinations(forwarder, forwarder_combinations) -> Tuple[bool, str]:
         """Check for unique combination of tg_channel_id and discord_channel_id"""
@@ -250,38 +318,26 @@ class Config:  # pylint: disable=too-many-instance-attributes
         return True, ""
 
     @ staticmethod
-    def validate_shared_hashtags(forwarders) -> Tuple[bool, str]:
-        """Check for shared hashtags in forwarders with the same tg_channel_id"""
-        tg_channel_hashtags = {}
-        for forwarder in forwarders:
-            tg_channel_id = forwarder["tg_channel_id"]
-            forward_hashtags = {tag["name"].lower() for tag in forwarder.get(
-                "forward_hashtags", [])} if forwarder.get("forward_hashtags") else set()
-
-            if forward_hashtags:  # Only process non-empty forward_hashtags
-                if tg_channel_id not in tg_channel_hashtags:
-                    tg_channel_hashtags[tg_channel_id] = [forward_hashtags]
-                else:
-                    for existing_hashtags in tg_channel_hashtags[tg_channel_id]:
-                        shared_hashtags = existing_hashtags.intersection(
-                            forward_hashtags)
-                        if shared_hashtags:
-                            return False, f"Shared hashtags {shared_hashtags} found for forwarders with tg_channel_id {tg_channel_id}. The same message will be forwarded multiple times."  # pylint: disable=line-too-long
-
-                    tg_channel_hashtags[tg_channel_id].append(forward_hashtags)
+    def validate_shared_hashtags(forwarder, forward_hashtags_names, tg_channel_hashtags) -> Tuple[bool, str]:
+        """Check for shared hashtags with the previous forwarders with the same tg_channel_id"""
+        if not forward_hashtags_names:  # Only process non-empty forward_hashtags
+            return True, ""
 
+        tg_channel_id = forwarder["tg_channel_id"]
+        seen_hashtags = tg_channel_hashtags.setdefault(tg_channel_id, set())
+        if not seen_hashtags.isdisjoint(forward_hashtags_names):
+            shared_hashtags = seen_hashtags.intersection(forward_hashtags_names)
+            return False, f"Shared hashtags {shared_hashtags} found for forwarders with tg_channel_id {tg_channel_id}. The same message will be forwarded multiple times."  # pylint: disable=line-too-long
+
+        seen_hashtags |= forward_hashtags_names
         return True, ""
 
     @staticmethod
-    def validate_hashtags_overlap(forwarder, forward_hashtags, excluded_hashtags) -> Tuple[bool, str]:
+    def validate_hashtags_overlap(forwarder, forward_hashtags_names, excluded_hashtags_names) -> Tuple[bool, str]:
         """Check for overlapping hashtags between forward_hashtags and excluded_hashtags"""
         tg_channel_id = forwarder["tg_channel_id"]
-        forward_hashtags_names = {tag["name"].lower()
-                                  for tag in forward_hashtags}
-        excluded_hashtags_names = {tag["name"].lower()
-                                   for tag in excluded_hashtags}
-        common_hashtags = forward_hashtags_names.intersection(
-            excluded_hashtags_names)
+        common_hashtags = set(forward_hashtags_names.intersection(
+            excluded_hashtags_names))
         if common_hashtags:
             return False, f"Invalid configuration: overlapping hashtags {common_hashtags} found in forward_hashtags and excluded_hashtags for forwarder with `tg_channel_id` {tg_channel_id}"  # pylint: disable=line-too-long
 
@@ -292,52 +348,70 @@ class Config:  # pylint: disable=too-many-instance-attributes
         """Validate the configuration."""
         forwarders = config["telegram_forwarders"]
         forwarder_combinations = set()
+        forwarder_names = set()
+        tg_channel_hashtags: Dict[Any, set] = {}
+        shared_hashtags_error = ""
 
-        valid = True
         errors: List[str] = []
 
-        valid, error = Config.validate_openai_enabled(config["openai"])
-        if not valid:
+        ok, error = Config.validate_openai_enabled(config["openai"])
+        if not ok:
             errors.append(error)
 
-        forwarder_error_string = "Invalid forwarder configuration:"
+        # Only the first error of each forwarder is reported, the remaining checks are skipped.
         for forwarder in forwarders:
-            forwarder_error_string = f"{forwarder_error_string} forwarder name: {forwarder['forwarder_name']}"
+            forwarder_error_string = f"Invalid forwarder configuration: forwarder name: {forwarder['forwarder_name']}"
 
-            forward_hashtags = Config.get_forward_hashtags(forwarder)
+            # A null `forward_hashtags` is normalised once, every check below iterates it.
+            forward_hashtags = Config.get_forward_hashtags(forwarder) or []
 
-            if len(forward_hashtags) <= 0 and forwarder["forward_everything"] is False:
-                valid = False
+            if not forward_hashtags and forwarder["forward_everything"] is False:
                 errors.append(
                     f'{forwarder_error_string} `forward_hashtags` must be set when `forward_everything` is False')  # pylint: disable=line-too-long
+                continue
 
-            excluded_hashtags = Config.get_excluded_hashtags(forwarder)
+            ok, error = Config.validate_forwarder_types(forwarder)
+            if not ok:
+                errors.append(f"{forwarder_error_string} {error}")
+                continue
 
-            valid, error = Config.validate_forwarder_types(forwarder)
-            if not valid:
+            ok, error = Config.validate_forwarder_name(forwarder, forwarder_names)
+            if not ok:
                 errors.append(f"{forwarder_error_string} {error}")
+                continue
 
-            valid, error = Config.validate_forwarder_combinations(
+            ok, error = Config.validate_forwarder_combinations(
                 forwarder, forwarder_combinations)
-            if not valid:
+            if not ok:
                 errors.append(f"{forwarder_error_string} {error}")
+                continue
 
-            valid, error = Config.validate_mention_everyone_and_override(
+            ok, error = Config.validate_mention_everyone_and_override(
                 forwarder, forward_hashtags)
-            if not valid:
+            if not ok:
                 errors.append(f"{forwarder_error_string} {error}")
+                continue
 
-            valid, error = Config.validate_hashtags_overlap(
-                forwarder, forward_hashtags, excluded_hashtags)
-            if not valid:
+            # The hashtags names are computed once and shared by the checks below.
+            forward_hashtags_names = Config.get_hashtag_names(forward_hashtags)
+            excluded_hashtags_names = Config.get_hashtag_names(
+                Config.get_excluded_hashtags(forwarder))
+
+            ok, error = Config.validate_hashtags_overlap(
+                forwarder, forward_hashtags_names, excluded_hashtags_names)
+            if not ok:
                 errors.append(f"{forwarder_error_string} {error}")
+                continue
 
-        valid, error = Config.validate_shared_hashtags(forwarders)
-        if not valid:
-            errors.append(error)
+            # Only the first shared hashtags conflict is reported.
+            if not shared_hashtags_error:
+                ok, shared_hashtags_error = Config.validate_shared_hashtags(
+                    forwarder, forward_hashtags_names, tg_channel_hashtags)
+
+        if shared_hashtags_error:
+            errors.append(shared_hashtags_error)
 
-        valid = not errors
-        return valid, errors
+        return not errors, errors
 
     @staticmethod
     def get_excluded_hashtags(forwarder):
@@ -359,9 +433,29 @@ class Config:  # pylint: disable=too-many-instance-attributes
 
         return forward_hashtags
 
+    @staticmethod
+    def get_hashtag_names(hashtags) -> FrozenSet[str]:
+        """Get the lowercased names of a list of hashtags."""
+        return frozenset(sys.intern(tag["name"].lower()) for tag in hashtags or ())
+
     def get_telegram_channel_by_forwarder_name(self, forwarder_name: str):
         """Get the Telegram channel ID associated with a given forwarder ID."""
-        for forwarder in self.telegram_forwarders:
-            if forwarder.get("forwarder_name") == forwarder_name:
-                return forwarder.get("tg_channel_id")
-        return None
+        return self._forwarder_by_name.get(forwarder_name, {}).get("tg_channel_id")
+
+    def get_forwarders_by_tg_channel(self, tg_channel_id) -> List[dict]:
+        """Get the forwarders associated with a given Telegram channel ID."""
+        return self._forwarders_by_tg_channel.get(tg_channel_id, [])
+
+    def get_forward_hashtag_names(self, forwarder_name: str) -> FrozenSet[str]:
+        """Get the lowercased forward_hashtags names of a forwarder."""
+        return self._forward_hashtag_names.get(forwarder_name, frozenset())
+
+    def get_excluded_hashtag_names(self, forwarder_name: str) -> FrozenSet[str]:
+        """Get the lowercased excluded_hashtags names of a forwarder."""
+        return self._excluded_hashtag_names.get(forwarder_name, frozenset())
+
+
+@functools.lru_cache(maxsize=8)
+def _load_config(file_path: str, mtime_ns: int) -> Config:  # pylint: disable=unused-argument
+    """Load the configuration of a file, the modification time is part of the cache key."""
+    return Config(file_path)
@@ -43,6 +43,9 @@ async def start(telegram_client: TelegramClient, discord_client: discord.Client,
     """Start the bridge."""
     logger.info("Starting the bridge...")
 
+    # Load the messages history once, it is kept in memory afterwards.
+    await history_manager.initialize()
+
     input_channels_entities = []
 
     async for dialog in telegram_client.iter_dialogs():
@@ -159,22 +162,22 @@ async def handle_new_message(event, config: Config, telegram_client: TelegramCli
             message_forward_hashtags = get_message_forward_hashtags(
                 event.message)
 
-            matching_forward_hashtags = [
-                tag for tag in forwarder_config["allowed_forward_hashtags"] if tag["name"].lower() in message_forward_hashtags]
+            matching_forward_hashtag_names = config.get_forward_hashtag_names(
+                forwarder_name).intersection(message_forward_hashtags)
 
-            if len(matching_forward_hashtags) > 0:
+            if matching_forward_hashtag_names:
                 should_forward_message = True
+                # The tags themselves are only looked up for their override_mention_everyone flag.
                 mention_everyone = any(tag.get("override_mention_everyone", False)
-                                       for tag in matching_forward_hashtags)
+                                       for tag in forwarder_config["allowed_forward_hashtags"]
+                                       if tag["name"].lower() in matching_forward_hashtag_names)
 
         if forwarder_config["disallowed_hashtags"]:
             message_forward_hashtags = get_message_forward_hashtags(
                 event.message)
 
-            matching_forward_hashtags = [
-                tag for tag in forwarder_config["disallowed_hashtags"] if tag["name"].lower() in message_forward_hashtags]
-
-            if len(matching_forward_hashtags) > 0:
+            excluded_hashtag_names = config.get_excluded_hashtag_names(forwarder_name)
+            if not excluded_hashtag_names.isdisjoint(message_forward_hashtags):
                 should_forward_message = False
 
         if not should_forward_message:
@@ -226,7 +229,7 @@ async def handle_new_message(event, config: Config, telegram_client: TelegramCli
             await history_manager.clean_history_data()
             await history_manager.save_mapping_data(forwarder_name, event.message.id,
                                                     main_sent_discord_message.id)
-            history_manager.clean_old_media()
+            await history_manager.clean_old_media()
             logger.info("Forwarded TG message %s to Discord message %s",
                         event.message.id, main_sent_discord_message.id)
             logger.debug("Saving message data to append only file")
@@ -241,12 +244,13 @@ async def handle_new_message(event, config: Config, telegram_client: TelegramCli
 
 def get_matching_forwarders(tg_channel_id, config: Config):
     """Get the forwarders that match the given Telegram channel ID."""
-    return [forwarder_config for forwarder_config in config.telegram_forwarders if tg_channel_id == forwarder_config["tg_channel_id"]]  # pylint: disable=line-too-long
+    return config.get_forwarders_by_tg_channel(tg_channel_id)
 
 
 async def on_restored_connectivity(config: Config, telegram_client: TelegramClient, discord_client: discord.Client):
     """Check and restore internet connectivity."""
     logger.debug("Checking for internet connectivity")
+    await history_manager.initialize()
     while True:
 
         if config.app.internet_connected and config.telegram.is_healthy is True:
@@ -265,7 +269,11 @@ async def on_restored_connectivity(config: Config, telegram_client: TelegramClie
                         forwarder_name)
 
                     if channel_id:
-                        fetched_messages = await history_manager.fetch_messages_after(last_tg_message_id,
+                        # With a backfill_limit, a window of messages that are all filtered out would be
+                        # fetched again on every pass, the backfill resumes after the last handled message.
+                        backfill_offset = history_manager.get_backfill_offset(forwarder_name,
+                                                                              last_tg_message_id)
+                        fetched_messages = await history_manager.fetch_messages_after(backfill_offset,
                                                                                       channel_id,
                                                                                       telegram_client)
                         for fetched_message in fetched_messages:
@@ -281,6 +289,7 @@ async def on_restored_connectivity(config: Config, telegram_client: TelegramClie
                                 logger.warning("Discord is not available despite the connectivty is restored, queing TG message %s",
                                                event.message.id)
                                 await add_to_queue(event)
+                                history_manager.set_last_scanned_message(forwarder_name, fetched_message.id)
                                 continue
                             # delay the message delivery to avoid rate limit and flood
                             await asyncio.sleep(config.app.recoverer_delay)
@@ -289,6 +298,7 @@ async def on_restored_connectivity(config: Config, telegram_client: TelegramClie
                             await handle_new_message(event, config,
                                                      telegram_client,
                                                      discord_client)
+                            history_manager.set_last_scanned_message(forwarder_name, fetched_message.id)
 
             except Exception as exception:  # pylint: disable=broad-except
                 logger.error(
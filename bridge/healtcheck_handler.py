@@ -93,6 +93,8 @@ async def healthcheck(dispatcher: EventDispatcher, tgc: TelegramClient, dcl: dis
             # set the Discord availability status to False
             config.discord.is_healthy = False
 
-        dispatcher.notify("healthcheck", config)
+        # The healthcheck events are only consumed by the API.
+        if config.api.enabled:
+            dispatcher.notify("healthcheck", config)
         # Sleep for the given interval and retry
         await asyncio.sleep(interval)
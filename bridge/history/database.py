@@ -0,0 +1,112 @@
+"""SQLite storage of the messages history.
+
+The functions of this module are blocking, and must all be called from the
+thread that opened the connection.
+"""
+import os
+import sqlite3
+from typing import Dict, Iterable, Optional, Tuple
+
+import orjson
+
+CREATE_MAPPING_TABLE = """
+CREATE TABLE IF NOT EXISTS mapping(
+    forwarder TEXT NOT NULL,
+    tg_id INTEGER NOT NULL,
+    discord_id INTEGER NOT NULL,
+    PRIMARY KEY(forwarder, tg_id)
+) WITHOUT ROWID
+"""
+
+# Bumped once the schema is created and the legacy history imported, in the same transaction.
+SCHEMA_VERSION = 1
+
+INSERT_MAPPING = "INSERT OR REPLACE INTO mapping VALUES(?, ?, ?)"
+
+SELECT_DISCORD_ID = "SELECT discord_id FROM mapping WHERE forwarder = ? AND tg_id = ?"
+
+# SQLite returns the discord_id of the row holding the MAX(tg_id) of each group.
+SELECT_LAST_MESSAGES = "SELECT forwarder, MAX(tg_id), discord_id FROM mapping GROUP BY forwarder"
+
+DELETE_ALL_BUT_LAST_MESSAGES = """
+DELETE FROM mapping WHERE (forwarder, tg_id) NOT IN (
+    SELECT forwarder, MAX(tg_id) FROM mapping GROUP BY forwarder
+)
+"""
+
+
+def open_database(db_path: str, legacy_history_file: Optional[str] = None) -> sqlite3.Connection:
+    """Open the history database, creating it from the legacy JSON history file if it is not set up yet.
+
+    The schema version is only recorded once the legacy history is imported, a failed
+    import leaves the database empty and is retried on the next start.
+    """
+    os.makedirs(os.path.dirname(db_path) or os.curdir, exist_ok=True)
+
+    connection = sqlite3.connect(db_path)
+    try:
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+
+        if connection.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            with connection:
+                connection.execute("BEGIN")
+                connection.execute(CREATE_MAPPING_TABLE)
+                if legacy_history_file is not None:
+                    connection.executemany(INSERT_MAPPING, read_legacy_history_file(legacy_history_file))
+                connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    except Exception:
+        connection.close()
+        raise
+
+    return connection
+
+
+def read_legacy_history_file(file_path: str) -> Iterable[Tuple[str, int, int]]:
+    """Read the mappings of a JSON history file.
+
+    A missing, empty or invalid file has nothing to import. Docker creates a missing
+    bind-mounted file as a directory.
+    """
+    try:
+        with open(file_path, "rb") as history_file:
+            history_data = orjson.loads(history_file.read() or b"{}")
+    except (FileNotFoundError, IsADirectoryError, orjson.JSONDecodeError):
+        return []
+
+    if not isinstance(history_data, dict):
+        return []
+
+    # The previous releases also saved the missed messages in this file, as lists
+    # in place of the Discord message IDs, they are not mappings and are skipped.
+    return [(forwarder_name, int(tg_message_id), discord_message_id)
+            for forwarder_name, forwarder_data in history_data.items() if isinstance(forwarder_data, dict)
+            for tg_message_id, discord_message_id in forwarder_data.items()
+            if tg_message_id.isdigit() and type(discord_message_id) is int]  # pylint: disable=unidiomatic-typecheck
+
+
+def insert_mappings(connection: sqlite3.Connection, mappings: Iterable[Tuple[str, int, int]]) -> None:
+    """Insert or replace mappings in a single transaction."""
+    with connection:
+        connection.executemany(INSERT_MAPPING, mappings)
+
+
+def select_discord_message_id(connection: sqlite3.Connection,
+                              forwarder_name: str, tg_message_id: int) -> Optional[int]:
+    """Get the Discord message ID mapped to a TG message of a forwarder."""
+    row = connection.execute(SELECT_DISCORD_ID, (forwarder_name, tg_message_id)).fetchone()
+    return row[0] if row else None
+
+
+def select_last_messages(connection: sqlite3.Connection) -> Dict[str, Tuple[int, int]]:
+    """Get the last TG message ID of each forwarder, with its Discord message ID."""
+    return {forwarder_name: (tg_message_id, discord_message_id)
+            for forwarder_name, tg_message_id, discord_message_id in connection.execute(SELECT_LAST_MESSAGES)}
+
+
+def delete_all_but_last_messages(connection: sqlite3.Connection) -> None:
+    """Delete the mappings except the last one of each forwarder, and shrink the database files."""
+    with connection:
+        connection.execute(DELETE_ALL_BUT_LAST_MESSAGES)
+    connection.execute("VACUUM")
+    connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
@@ -1,24 +1,46 @@
 """Messages history handler"""
 import os
 import asyncio
-import json
-import glob
+import logging
+import re
 from datetime import date
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from typing import Any, List, Optional
 
 import aiofiles
+import aiofiles.os
+import orjson
 from telethon import TelegramClient
 
 from bridge.config import Config
+from bridge.history import database
 from bridge.logger import Logger
 
 config = Config()
 logger = Logger.get_logger(config.app.name)
 
+# The database lives in its own directory, together with its write-ahead log files,
+# so that a single bind mount keeps all of them in the container deployment.
+MESSAGES_HISTORY_DB_FILE = os.path.join("data", "messages_history.db")
+# The JSON history file of the previous releases, imported when the database is created.
 MESSAGES_HISTORY_FILE = "messages_history.json"
 MISSED_MESSAGES_HISTORY_FILE = "missed_messages_history.json"
 
+# The media files downloaded from Telegram are named after a UUID.
+MEDIA_FILE_NAME_PATTERN = re.compile(
+    r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\..*")
+
+
+# The history files are read and written through their own threads, so that slow
+# disk I/O doesn't hold the default executor used by DNS lookups and to_thread.
+history_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="hist-io")
+# The SQLite connection is only ever used from this single thread.
+history_database_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hist-db")
+
+# The maximum number of queued mappings written in a single transaction.
+MAX_MAPPINGS_WRITE_BATCH = 512
+
 
 class MessageHistoryHandler:
     """Messages history handler."""
@@ -27,71 +49,124 @@ class MessageHistoryHandler:
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
-            cls._mapping_data_cache = None
+            cls._db = None
+            cls._missed_messages_cache = None
+            # The last saved TG and Discord message IDs of each forwarder.
+            cls._last_messages = {}
+            # The last TG message ID handled by the backfill of each forwarder, forwarded or
+            # filtered out, so that the next backfill pass resumes after it.
+            cls._last_scanned_messages = {}
+            # The mappings saved but not written yet, drained in batches by _mappings_writer.
+            cls._write_queue = asyncio.Queue()
+            cls._pending_mappings = {}
+            cls._mappings_writer = None
+            # Only the first load of the history is guarded by _lock, the in-memory
+            # data is then updated without locking. _write_lock serializes the file writes.
             cls._lock = asyncio.Lock()
+            cls._write_lock = asyncio.Lock()
         return cls._instance
 
-    async def load_mapping_data(self) -> dict:
-        """Load the mapping data from the mapping file."""
+    async def initialize(self) -> None:
+        """Open the history database and load the missed messages once."""
+        if self._db is not None and self._missed_messages_cache is not None:
+            return
+
         async with self._lock:
-            logger.debug("Loading mapping data...")
-            if self._mapping_data_cache is None:
+            if self._db is None:
+                logger.debug("Opening the messages history database...")
+                self._db = await run_in_history_database(database.open_database,
+                                                         MESSAGES_HISTORY_DB_FILE,
+                                                         MESSAGES_HISTORY_FILE)
+                self._last_messages = await run_in_history_database(database.select_last_messages, self._db)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Loaded the mapping data of %d forwarders", len(self._last_messages))
+                self._mappings_writer = asyncio.create_task(self.write_queued_mappings())
+
+            if self._missed_messages_cache is None:
                 try:
-                    async with aiofiles.open(MESSAGES_HISTORY_FILE, "r", encoding="utf-8") as messages_mapping:
-                        data = json.loads(await messages_mapping.read())
-                        logger.debug("Loaded mapping data: %s", data)
-                        self._mapping_data_cache = data
+                    async with aiofiles.open(MISSED_MESSAGES_HISTORY_FILE, "rb", executor=history_executor) as missed_messages_mapping:
+                        data = orjson.loads(await missed_messages_mapping.read() or b"{}")
+                    self._missed_messages_cache = with_int_message_ids(data)
                 except FileNotFoundError:
-                    self._mapping_data_cache = {}
+                    self._missed_messages_cache = {}
+
+    async def close(self) -> None:
+        """Write the queued mappings and close the history database, checkpointing its write-ahead log."""
+        if self._mappings_writer is not None:
+            await self._write_queue.join()
+            self._mappings_writer.cancel()
+            self._mappings_writer = None
 
-            return self._mapping_data_cache
+        async with self._lock, self._write_lock:
+            if self._db is not None:
+                await run_in_history_database(self._db.close)
+                self._db = None
 
     async def save_mapping_data(self, forwarder_name: str, tg_message_id: int, discord_message_id: int) -> None:
-        """Save the mapping data to the mapping file."""
-        # async with self._lock:
-        mapping_data = await self.load_mapping_data()
+        """Save the mapping data to the history database."""
+        if self._db is None:
+            await self.initialize()
 
-        logger.debug("Saving mapping data: %s, %s, %s", forwarder_name,
-                     tg_message_id, discord_message_id)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Saving mapping data: %s, %s, %s", forwarder_name,
+                         tg_message_id, discord_message_id)
 
-        if forwarder_name not in mapping_data:
-            mapping_data[forwarder_name] = {}
+        last_tg_message_id, _ = self._last_messages.get(forwarder_name, (0, None))
+        if tg_message_id >= last_tg_message_id:
+            self._last_messages[forwarder_name] = tg_message_id, discord_message_id
 
-        mapping_data[forwarder_name][tg_message_id] = discord_message_id
-        try:
-            async with aiofiles.open(MESSAGES_HISTORY_FILE, "w", encoding="utf-8") as messages_mapping:
-                await messages_mapping.write(json.dumps(mapping_data, indent=4))
+        # The mapping is written by _mappings_writer, together with the other queued ones.
+        self._pending_mappings[forwarder_name, tg_message_id] = discord_message_id
+        self._write_queue.put_nowait((forwarder_name, tg_message_id, discord_message_id))
 
-            self._mapping_data_cache = mapping_data
+    async def write_queued_mappings(self) -> None:
+        """Write the queued mappings to the history database, in a single transaction per batch."""
+        while True:
+            mappings = [await self._write_queue.get()]
+            while len(mappings) < MAX_MAPPINGS_WRITE_BATCH and not self._write_queue.empty():
+                mappings.append(self._write_queue.get_nowait())
 
-            logger.debug("Mapping data saved successfully.")
+            try:
+                async with self._write_lock:
+                    await run_in_history_database(database.insert_mappings, self._db, mappings)
 
-            if config.app.debug:
-                logger.debug("Current mapping data: %s", mapping_data)
+                logger.debug("Saved %s mappings successfully.", len(mappings))
 
-        except Exception as ex:  # pylint: disable=broad-except
-            logger.error(
-                "An error occurred while saving mapping data: %s", ex, exc_info=config.app.debug)
+            except Exception as ex:  # pylint: disable=broad-except
+                logger.error(
+                    "An error occurred while saving mapping data: %s", ex, exc_info=config.app.debug)
+            finally:
+                for forwarder_name, tg_message_id, discord_message_id in mappings:
+                    if self._pending_mappings.get((forwarder_name, tg_message_id)) == discord_message_id:
+                        del self._pending_mappings[forwarder_name, tg_message_id]
+                    self._write_queue.task_done()
 
     async def save_missed_message(self, forwarder_name: str, tg_message_id: int, discord_channel_id: int, exception: Any) -> None:
         """Save the missed message to the missed messages file."""
-        mapping_data = await self.load_mapping_data()
+        if self._missed_messages_cache is None:
+            await self.initialize()
+        missed_messages_data = self._missed_messages_cache
 
-        logger.debug("Saving missed message: %s, %s, %s, %s", forwarder_name,
-                     tg_message_id, discord_channel_id, exception)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Saving missed message: %s, %s, %s, %s", forwarder_name,
+                         tg_message_id, discord_channel_id, exception)
 
-        if forwarder_name not in mapping_data:
-            mapping_data[forwarder_name] = {}
+        if forwarder_name not in missed_messages_data:
+            missed_messages_data[forwarder_name] = {}
 
-        mapping_data[forwarder_name][tg_message_id] = discord_channel_id, exception
+        missed_messages_data[forwarder_name][tg_message_id] = discord_channel_id, exception
         try:
-            async with aiofiles.open(MISSED_MESSAGES_HISTORY_FILE, "w", encoding="utf-8") as missed_messages_mapping:
-                await missed_messages_mapping.write(json.dumps(mapping_data, indent=4))
+            async with self._write_lock, aiofiles.open(MISSED_MESSAGES_HISTORY_FILE, "wb", executor=history_executor) as missed_messages_mapping:
+                await missed_messages_mapping.write(
+                    orjson.dumps(missed_messages_data, option=orjson.OPT_NON_STR_KEYS))
 
             logger.debug("Missed message saved successfully.")
 
-            if config.app.debug:
-                logger.debug("Current missed messages data: %s", mapping_data)
+            # Only the size of the missed messages data is logged, it is never formatted whole.
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Current missed messages data: %d forwarders, %d total entries",
+                             len(missed_messages_data),
+                             sum(len(forwarder_data) for forwarder_data in missed_messages_data.values()))
 
         except Exception as ex:  # pylint: disable=broad-except
             logger.error(
@@ -99,67 +174,81 @@ class MessageHistoryHandler:
 
     async def get_discord_message_id(self, forwarder_name: str, tg_message_id: int) -> Optional[int]:
         """Get the Discord message ID associated with the given TG message ID for the specified forwarder."""
-        mapping_data = await self.load_mapping_data()
-        forwarder_data = mapping_data.get(forwarder_name, None)
-
-        if forwarder_data is not None:
-            return forwarder_data.get(tg_message_id, None)
-
-        return None
+        if self._db is None:
+            await self.initialize()
+        pending_discord_message_id = self._pending_mappings.get((forwarder_name, tg_message_id))
+        if pending_discord_message_id is not None:
+            return pending_discord_message_id
+        return await run_in_history_database(database.select_discord_message_id, self._db,
+                                             forwarder_name, tg_message_id)
 
     async def get_last_messages_for_all_forwarders(self) -> List[dict]:
         """Get the last messages for each forwarder."""
-        mapping_data = await self.load_mapping_data()
+        if self._db is None:
+            await self.initialize()
         last_messages = []
-        if mapping_data.items():
-            for forwarder_name, forwarder_data in mapping_data.items():
-                if not forwarder_data:
-                    logger.debug("No messages found in the history for forwarder %s",
-                                 forwarder_name)
-                    continue
-                last_tg_message_id = max(forwarder_data, key=int)
-                logger.debug("Last TG message ID for forwarder %s: %s",
-                             forwarder_name, last_tg_message_id)
-                discord_message_id = forwarder_data[last_tg_message_id]
-                last_messages.append({
-                    "forwarder_name": forwarder_name,
-                    "telegram_id": int(last_tg_message_id),
-                    "discord_id": discord_message_id
-                })
+        for forwarder_name, (last_tg_message_id, discord_message_id) in self._last_messages.items():
+            logger.debug("Last TG message ID for forwarder %s: %s",
+                         forwarder_name, last_tg_message_id)
+            last_messages.append({
+                "forwarder_name": forwarder_name,
+                "telegram_id": last_tg_message_id,
+                "discord_id": discord_message_id
+            })
         return last_messages
 
+    def get_backfill_offset(self, forwarder_name: str, last_tg_message_id: int) -> int:
+        """Get the TG message ID the backfill of a forwarder resumes after."""
+        return max(last_tg_message_id, self._last_scanned_messages.get(forwarder_name, 0))
+
+    def set_last_scanned_message(self, forwarder_name: str, tg_message_id: int) -> None:
+        """Advance the backfill of a forwarder past a handled TG message."""
+        if tg_message_id > self._last_scanned_messages.get(forwarder_name, 0):
+            self._last_scanned_messages[forwarder_name] = tg_message_id
+
     async def fetch_messages_after(self, last_tg_message_id: int, channel_id: int, tgc: TelegramClient) -> List:
         """Fetch messages after the last TG message ID."""
         logger.debug("Fetching messages after %s", last_tg_message_id)
         messages = []
-        async for message in tgc.iter_messages(channel_id, offset_id=last_tg_message_id, reverse=True):
-            logger.debug("Fetched message: %s", message.id)
-            messages.append(message)
+        append_message = messages.append
+        async for message in tgc.iter_messages(channel_id, offset_id=last_tg_message_id, reverse=True,
+                                               limit=config.app.backfill_limit):
+            if config.app.debug and logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Fetched message: %s", message.id)
+            append_message(message)
         return messages
 
     async def clean_history_data(self) -> None:
-        async with self._lock:
-            logger.debug("Cleaning old history data")
-            try:
-                if os.stat(MESSAGES_HISTORY_FILE).st_size / (1024 * 1024) > config.app.history_size_limit or os.stat(MISSED_MESSAGES_HISTORY_FILE).st_size / (1024 * 1024) > config.app.history_size_limit:
-                    open(MESSAGES_HISTORY_FILE, "w").close()
-                    open(MISSED_MESSAGES_HISTORY_FILE, "w").close()
-            except Exception as ex: 
-                logger.error("Failed rotating the history file! Make sure that the storage growth does not get out of hand!")
-
-    def clean_old_media(self) -> None:
+        logger.debug("Cleaning old history data")
+        try:
+            # The sizes are read without holding the lock, saving the mapping data doesn't wait on the disk.
+            history_size = (await get_file_size(MESSAGES_HISTORY_DB_FILE)
+                            + await get_file_size(f"{MESSAGES_HISTORY_DB_FILE}-wal"))
+            missed_messages_size = await get_file_size(MISSED_MESSAGES_HISTORY_FILE)
+            if history_size / (1024 * 1024) > config.app.history_size_limit or missed_messages_size / (1024 * 1024) > config.app.history_size_limit:
+                async with self._write_lock:
+                    # The last message of each forwarder is kept to recover the messages missed after it.
+                    if self._db is not None:
+                        await run_in_history_database(database.delete_all_but_last_messages, self._db)
+                    await run_in_history_executor(truncate_files, MISSED_MESSAGES_HISTORY_FILE)
+                    if self._missed_messages_cache is not None:
+                        self._missed_messages_cache = {}
+        except Exception as ex: 
+            logger.error("Failed rotating the history file! Make sure that the storage growth does not get out of hand!")
+
+    async def clean_old_media(self) -> None:
         logger.debug("Cleaning old files ")
         try:
-            files = glob.glob('[0-9a-f]'*8+'-'+'[0-9a-f]'*4+'-'+'[0-9a-f]'*4+'-'+'[0-9a-f]'*4+'-'+'[0-9a-f]'*12+'.*')
-            for file in files:
-                os.remove(file)
+            # The directory walk and the unlinks run in a single worker thread hop,
+            # without stalling the event loop.
+            await run_in_history_executor(remove_media_files, os.curdir)
         except Exception as ex:
             logger.error("Failed deleting old media file! Make sure that the storage growth does not get out of hand!")
 
     async def append_message_to_file(self, filename, sent_discord_messages) -> None:
         dated_filename = filename + "-" + datetime.now().replace(tzinfo=timezone.utc).astimezone(tz=None).strftime('%Y-%m-%d') + ".txt"
         try:
-            async with aiofiles.open(dated_filename, "a", encoding="utf-8") as file:
+            async with aiofiles.open(dated_filename, "a", encoding="utf-8", executor=history_executor) as file:
                 for message in sent_discord_messages:
                     formatted_message = message.created_at.replace(tzinfo=timezone.utc).astimezone(tz=None).strftime("%Y/%m/%d, %H:%M:%S") + ": " + message.embeds[0].description + "\n"
                     await file.write(formatted_message)
@@ -169,3 +258,41 @@ class MessageHistoryHandler:
         except Exception as ex:  # pylint: disable=broad-except
             logger.error(
                 "An error occurred while saving message: %s", ex, exc_info=config.app.debug)
+
+
+async def run_in_history_executor(func, *args):
+    """Run a blocking file operation in the history executor."""
+    return await asyncio.get_running_loop().run_in_executor(history_executor, func, *args)
+
+
+async def run_in_history_database(func, *args):
+    """Run a blocking history database operation in the history database thread."""
+    return await asyncio.get_running_loop().run_in_executor(history_database_executor, func, *args)
+
+
+def remove_media_files(directory: str) -> None:
+    """Remove the downloaded media files of a directory."""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if MEDIA_FILE_NAME_PATTERN.fullmatch(entry.name) and entry.is_file():
+                os.remove(entry.path)
+
+
+def with_int_message_ids(data: dict) -> dict:
+    """Convert the TG message IDs of the per forwarder data back to integers, JSON keys are strings."""
+    return {forwarder_name: {int(tg_message_id): value for tg_message_id, value in forwarder_data.items()}
+            for forwarder_name, forwarder_data in data.items()}
+
+
+async def get_file_size(file_path: str) -> int:
+    """Get the size of a file in bytes, 0 if it does not exist."""
+    try:
+        return (await aiofiles.os.stat(file_path, executor=history_executor)).st_size
+    except FileNotFoundError:
+        return 0
+
+
+def truncate_files(*file_paths: str) -> None:
+    """Truncate the given files, creating the missing ones."""
+    for file_path in file_paths:
+        open(file_path, "wb").close()  # pylint: disable=consider-using-with
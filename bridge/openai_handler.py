@@ -1,7 +1,8 @@
 """This module handles the communication with the OpenAI API."""
 import asyncio
-import functools
-import copy
+import hashlib
+import random
+from collections import OrderedDict
 
 import openai
 import openai.error
@@ -16,22 +17,74 @@ logger = Logger.get_logger(config.app.name)
 openai.api_key = config.openai.api_key
 openai.organization = config.openai.organization
 
+# The fixed parts of the suggestions prompt, surrounding the message text.
+SUGGESTIONS_PROMPT_PREFIX = "Given the message: '"
+SUGGESTIONS_PROMPT_SUFFIX = (
+    "', suggest related actions and correlated articles with links:\n"
+    "Related Actions:\n- ACTION1\n- ACTION2\n- ACTION3\n"
+    "Correlated Articles:\n1. ARTICLE1_TITLE - ARTICLE1_LINK\n"
+    "2. ARTICLE2_TITLE - ARTICLE2_LINK\n"
+    "3. ARTICLE3_TITLE - ARTICLE3_LINK\n"
+)
+
+# Bound the concurrent OpenAI requests, a burst of messages would otherwise get rate limited.
+MAX_CONCURRENT_REQUESTS = 8
+MAX_RATE_LIMIT_RETRIES = 3
+openai_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+# The successful responses of each helper, keyed by a hash of the message text.
+RESPONSES_CACHE_SIZE = 4096
+suggestions_cache: OrderedDict[bytes, str] = OrderedDict()
+sentiments_cache: OrderedDict[bytes, str] = OrderedDict()
+
+
+def get_text_key(text: str) -> bytes:
+    """Get the responses cache key of a message text."""
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+def get_cached_response(cache: OrderedDict, key: bytes) -> str | None:
+    """Get a cached response, marking it as the most recently used."""
+    response = cache.get(key)
+    if response is not None:
+        cache.move_to_end(key)
+    return response
+
+
+def cache_response(cache: OrderedDict, key: bytes, response: str) -> None:
+    """Cache a response, evicting the least recently used one when full."""
+    cache[key] = response
+    if len(cache) > RESPONSES_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+async def create_with_backoff(create, **kwargs):
+    """Call an OpenAI create coroutine with bounded concurrency, retrying the rate limited requests."""
+    for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+        try:
+            async with openai_semaphore:
+                return await create(**kwargs)
+        except openai.error.RateLimitError:
+            if attempt == MAX_RATE_LIMIT_RETRIES:
+                raise
+            # The semaphore is released while waiting, the other requests keep going.
+            delay = min(30, 2 ** attempt) + random.random()
+            logger.warning("Rate limited by OpenAI, retrying in %.1f seconds", delay)
+            await asyncio.sleep(delay)
+
 
 async def analyze_message_and_generate_suggestions(text: str) -> str:
     """analyze the message text and seek for suggestions."""
+    key = get_text_key(text)
+    cached_suggestion = get_cached_response(suggestions_cache, key)
+    if cached_suggestion is not None:
+        return cached_suggestion
 
-    loop = asyncio.get_event_loop()
     try:
-        create_completion = functools.partial(
-            openai.Completion.create,
+        response = await create_with_backoff(
+            openai.Completion.acreate,
             model="gpt-3.5-turbo-0125",
-            prompt=(
-                f"Given the message: '{text}', suggest related actions and correlated articles with links:\n"
-                f"Related Actions:\n- ACTION1\n- ACTION2\n- ACTION3\n"
-                f"Correlated Articles:\n1. ARTICLE1_TITLE - ARTICLE1_LINK\n"
-                f"2. ARTICLE2_TITLE - ARTICLE2_LINK\n"
-                f"3. ARTICLE3_TITLE - ARTICLE3_LINK\n"
-            ),
+            prompt=SUGGESTIONS_PROMPT_PREFIX + text + SUGGESTIONS_PROMPT_SUFFIX,
             temperature=0,
             max_tokens=60,
             top_p=1.0,
@@ -39,9 +92,8 @@ async def analyze_message_and_generate_suggestions(text: str) -> str:
             presence_penalty=0.0
         )
 
-        response = await loop.run_in_executor(None, create_completion)
-
         suggestion = response.choices[0].text.strip() # type: ignore # pylint: disable=no-member
+        cache_response(suggestions_cache, key, suggestion)
         return suggestion
     except openai.error.InvalidRequestError as ex:
         logger.error("Invalid request error: %s", {ex})
@@ -59,17 +111,22 @@ async def analyze_message_and_generate_suggestions(text: str) -> str:
 
 async def analyze_message_sentiment(text: str) -> str:
     """analyze the message text and seek for suggestions."""
-    loop = asyncio.get_event_loop()
+    key = get_text_key(text)
+    cached_suggestion = get_cached_response(sentiments_cache, key)
+    if cached_suggestion is not None:
+        return cached_suggestion
+
     try:
-        prompt = copy.deepcopy(config.openai.sentiment_analysis_prompt)
+        prompt = config.openai.sentiment_analysis_prompt
 
         if prompt is not None:
-            prompt.append({"role":"user","content":text})
+            # A shallow copy is enough, the configured messages are never mutated.
+            prompt = [*prompt, {"role":"user","content":text}]
 
         logger.debug("openai_sentiment_analysis_prompt %s", prompt)
 
-        create_completion = functools.partial(
-            openai.ChatCompletion.create,
+        response = await create_with_backoff(
+            openai.ChatCompletion.acreate,
             model=config.openai.model,
             temperature=config.openai.temperature,
             max_tokens=256,
@@ -79,10 +136,10 @@ async def analyze_message_sentiment(text: str) -> str:
             messages=(prompt)
         )
 
-        response = await loop.run_in_executor(None, create_completion)
-
         suggestion = response.choices[0].message.content # type: ignore # pylint: disable=no-member
         logger.debug("openai_sentiment_analysis_prompt result %s", suggestion)
+        if suggestion is not None:
+            cache_response(sentiments_cache, key, suggestion)
         return suggestion
     except openai.error.InvalidRequestError as ex:
         logger.error("Invalid request error: %s", {ex})
@@ -83,8 +83,8 @@ async def start_telegram_client(config: Config, event_loop: AbstractEventLoop |
     logger.info("Starting Telegram client...")
 
     if event_loop is None:
-        logger.debug("Creating a new event loop for Telegram client")
-        event_loop = asyncio.get_event_loop()
+        logger.debug("Using the running event loop for Telegram client")
+        event_loop = asyncio.get_running_loop()
 
     # telethon_logger = Logger.get_telethon_logger()
     # telethon_logger_handler = Logger.generate_handler(
@@ -1,30 +1,35 @@
 """handles the process of the bridge between telegram and discord"""
+from __future__ import annotations
 
 import argparse
 import asyncio
+import fcntl
 import os
 import signal
 import sys
-from asyncio import AbstractEventLoop
 from sqlite3 import OperationalError
-from typing import Tuple
-
-import discord
-import psutil  # pylint: disable=import-error
-from telethon import TelegramClient
+from typing import TYPE_CHECKING, Callable, Sequence, Tuple
 
 from bridge.config import Config
-from bridge.core import on_restored_connectivity, start
-from bridge.discord_handler import start_discord
 from bridge.enums import ProcessStateEnum
 from bridge.events import EventDispatcher
-from bridge.healtcheck_handler import healthcheck
 from bridge.logger import Logger
-from bridge.telegram_handler import start_telegram_client
+
+# The Telegram and Discord clients are imported when the bridge starts,
+# so that `--stop`, `--version` and the process state checks don't pay for them.
+if TYPE_CHECKING:
+    import discord
+    from telethon import TelegramClient
 
 config = Config()
 logger = Logger.init_logger(config.app.name, config.logger)
 
+# The descriptor holding the lock on the PID file for the lifetime of the bridge.
+pid_file_descriptor: int | None = None
+
+# Set once the clients of the running bridge have been shut down.
+shutdown_done = False
+
 # Create a Forwader class with context manager to handle the bridge process
 # class Forwarder:
 #     """Forwarder class."""
@@ -64,43 +69,68 @@ logger = Logger.init_logger(config.app.name, config.logger)
 
 
 def create_pid_file() -> str:
-    """Create a PID file."""
+    """Create a PID file and lock it for as long as the bridge is running."""
+    global pid_file_descriptor  # pylint: disable=global-statement
     logger.debug("Creating PID file.")
     # Get the process ID.
     pid = os.getpid()
 
     # Create the PID file.
     bot_pid_file = f'{config.app.name}.pid'
-    process_state, _ = determine_process_state(bot_pid_file)
 
-    if process_state == ProcessStateEnum.RUNNING:
-        sys.exit(1)
-
-    try:
-        with open(bot_pid_file, "w", encoding="utf-8") as pid_file:
-            pid_file.write(str(pid))
-    except OSError as err:
-        print(f"Unable to create PID file: {err}", flush=True)
-        sys.exit(0)
+    while True:
+        try:
+            descriptor = os.open(bot_pid_file, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as err:
+            print(f"Unable to create PID file: {err}", flush=True)
+            sys.exit(0)
+
+        try:
+            # The lock is held until the descriptor is closed, or the process dies.
+            fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(descriptor)
+            logger.error("The %s is already running.", config.app.name)
+            sys.exit(1)
+
+        # A stopping bridge may have removed the file between the open and the lock,
+        # the lock is only meaningful if it is held on the file the path still points to.
+        try:
+            if os.fstat(descriptor).st_ino == os.stat(bot_pid_file).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        os.close(descriptor)
+
+    # A stale PID file left by a dead process is reused, its content is replaced.
+    os.ftruncate(descriptor, 0)
+    os.write(descriptor, str(pid).encode())
+    pid_file_descriptor = descriptor
 
     return bot_pid_file
 
 
 def remove_pid_file(pid_file: str):
-    """Remove a PID file."""
+    """Remove a PID file and release its lock."""
+    global pid_file_descriptor  # pylint: disable=global-statement
     logger.debug("Removing PID file.")
     #determine if the pid file exists
     if not os.path.isfile(pid_file):
         logger.debug("PID file '%s' not found.", pid_file)
-        return
+    else:
+        try:
+            os.remove(pid_file)
+        except FileNotFoundError:
+            logger.error("PID file '%s' not found.", pid_file)
+        except Exception as ex:  # pylint: disable=broad-except
+            logger.exception(ex)
+            logger.error("Failed to remove PID file '%s'.", pid_file)
 
-    try:
-        os.remove(pid_file)
-    except FileNotFoundError:
-        logger.error("PID file '%s' not found.", pid_file)
-    except Exception as ex:  # pylint: disable=broad-except
-        logger.exception(ex)
-        logger.error("Failed to remove PID file '%s'.", pid_file)
+    # Release the lock only once the file is gone,
+    # so that a new process never locks a file that is about to be removed.
+    if pid_file_descriptor is not None:
+        os.close(pid_file_descriptor)
+        pid_file_descriptor = None
 
 
 def determine_process_state(pid_file: str | None = None) -> Tuple[ProcessStateEnum, int]:
@@ -108,13 +138,13 @@ def determine_process_state(pid_file: str | None = None) -> Tuple[ProcessStateEn
     Determine the state of the process.
 
     The state of the process is determined by looking for the PID file. If the
-    PID file does not exist, the process is considered stopped. If the PID file
-    does exist, the process is considered running.
+    PID file does not exist, the process is considered stopped.
 
-    If the PID file exists and the PID of the process that created it is not
-    running, the process is considered stopped. If the PID file exists and the
-    PID of the process that created it is running, the process is considered
-    running.
+    The running bridge holds an exclusive lock on its PID file. If the PID file
+    exists and is locked, and the PID it holds is alive, the process is
+    considered running. If the PID file exists and nobody holds its lock, the
+    process that created it is gone and the process is considered stopped. The
+    stale PID file is left in place, it is reused by the next bridge started.
 
     :param pid_file: The path to the PID file.
     :type pid_file: str
@@ -130,38 +160,43 @@ def determine_process_state(pid_file: str | None = None) -> Tuple[ProcessStateEn
         # The PID file does not exist, so the process is considered stopped.
         return ProcessStateEnum.STOPPED, 0
 
-    pid = 0
     try:
-        # Read the PID from the PID file.
-        with open(pid_file, "r", encoding="utf-8") as bot_pid_file:
-            pid = int(bot_pid_file.read().strip())
-
-            # If the PID file exists and the PID of the process that created it
-            # is not running, the process is considered stopped.
-            if not psutil.pid_exists(pid):
+        with open(pid_file, "rb", buffering=0) as bot_pid_file:
+            try:
+                fcntl.flock(bot_pid_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # The PID file is locked by the running process, read its PID.
+                pid = int(bot_pid_file.read() or 0)
+                if pid > 0 and is_process_running(pid):
+                    return ProcessStateEnum.RUNNING, pid
                 return ProcessStateEnum.STOPPED, 0
 
-            # If the PID file exists and the PID of the process that created it
-            # is running, the process is considered running.
-            return ProcessStateEnum.RUNNING, pid
-    except ProcessLookupError:
-        # If the PID file exists and the PID of the process that created it is
-        # not running, the process is considered stopped.
-        return ProcessStateEnum.ORPHANED, 0
-    except PermissionError:
-        # If the PID file exists and the PID of the process that created it is
-        # running, the process is considered running.
-        return ProcessStateEnum.RUNNING, pid
+            # Nobody holds the lock, so the process that created the PID file
+            # is not running anymore.
+            logger.debug("Found stale PID file '%s'.", pid_file)
+            return ProcessStateEnum.STOPPED, 0
     except FileNotFoundError:
         # The PID file does not exist, so the process is considered stopped.
         return ProcessStateEnum.STOPPED, 0
 
+
+def is_process_running(pid: int) -> bool:
+    """Probe whether a process with the given PID exists, without signalling it."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists, but belongs to another user.
+        return True
+    return True
+
 def stop_bridge():
     """Stop the bridge."""
     pid_file = f'{config.app.name}.pid'
 
     process_state, pid = determine_process_state(pid_file)
-    if process_state == ProcessStateEnum.STOPPED:
+    if process_state == ProcessStateEnum.STOPPED or pid <= 0:
         logger.warning(
             "PID file '%s' not found. The %s may not be running.", pid_file, config.app.name)
         return
@@ -176,11 +211,18 @@ def stop_bridge():
             "The %s process with PID %s is not running.", config.app.name, pid)
 
 
-async def on_shutdown(telegram_client, discord_client):
-    """Shutdown the bridge."""
+async def on_shutdown(telegram_client, discord_client, workers: Sequence[asyncio.Task] = ()):
+    """Shutdown the bridge, cancelling the given worker tasks.
+
+    Only the first call does the work, the clients are already closed afterwards.
+    """
+    global shutdown_done  # pylint: disable=global-statement
+    if shutdown_done:
+        logger.debug("Shutdown already done, skipping.")
+        return
+    shutdown_done = True
+
     logger.info("Starting shutdown process...")
-    task = asyncio.current_task()
-    all_tasks = asyncio.all_tasks()
 
     try:
         logger.info("Disconnecting Telegram client...")
@@ -196,76 +238,89 @@ async def on_shutdown(telegram_client, discord_client):
     except (Exception, asyncio.CancelledError) as ex:  # pylint: disable=broad-except
         logger.error("Error disconnecting Discord client: %s", {ex})
 
-    # if not config.api.enabled:
-    for running_task in all_tasks:
-        if running_task is not task and not running_task.done() and not running_task.cancelled():
-            if task is not None:
-                logger.debug("Cancelling task %s...", {running_task})
-                try:
-                    task.cancel()
-                except Exception as ex:  # pylint: disable=broad-except
-                    logger.error("Error cancelling task %s: %s", {
-                                running_task}, {ex})
+    for worker in workers:
+        if not worker.done():
+            logger.debug("Cancelling task %s...", {worker})
+            worker.cancel()
 
+    # gather does not cancel the other tasks when one fails, they were all cancelled above.
+    for result in await asyncio.gather(*workers, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.error("Error while running the bridge: %s",
+                         result, exc_info=result if config.app.debug else None)
 
-    if not config.api.enabled:
-        logger.debug("Stopping event loop...")
-        asyncio.get_running_loop().stop()
-    else:
-        remove_pid_file(f'{config.app.name}.pid')
+    try:
+        # pylint: disable=import-outside-toplevel
+        from bridge.history import MessageHistoryHandler
+        await MessageHistoryHandler().close()
+    except Exception as ex:  # pylint: disable=broad-except
+        logger.error("Error closing the messages history: %s", {ex})
 
     logger.info("Shutdown process completed.")
 
 
-async def shutdown(sig, tasks_loop: asyncio.AbstractEventLoop):
-    """Shutdown the application gracefully."""
-    logger.warning("shutdown received signal %s, shutting down...", {sig})
-
-    # Cancel all tasks
-    tasks = [task for task in asyncio.all_tasks(
-    ) if task is not asyncio.current_task()]
-
-    for task in tasks:
-        task.cancel()
-
-    # Wait for all tasks to be cancelled
-    results = await asyncio.gather(*tasks, return_exceptions=config.app.debug)
-
-    # Check for errors
-    for result in results:
-        if isinstance(result, asyncio.CancelledError):
-            continue
-        if isinstance(result, Exception):
-            logger.error("Error during shutdown: %s", result)
-
-    if not config.api.enabled:
-        # Stop the loop
-        if tasks_loop is not None:
-            tasks_loop.stop()
-
-    remove_pid_file(f'{config.app.name}.pid')
+def set_shutdown_signals(event_loop: asyncio.AbstractEventLoop,
+                         shutdown_event: asyncio.Event) -> Callable[[], None]:
+    """Set the shutdown event on SIGINT and SIGTERM.
 
+    The signals are written to a pipe through `signal.set_wakeup_fd`, and the
+    event loop sets the event when the pipe becomes readable. The wakeup fd is
+    process-wide, the numbers of the other signals are passed on to the
+    previous wakeup fd, such as the self-pipe of the running event loop.
+    Returns a function restoring the previous signal handling.
+    """
+    shutdown_signals = frozenset((signal.SIGINT, signal.SIGTERM))
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(read_fd, False)
+    os.set_blocking(write_fd, False)
+
+    def on_signal_received():
+        # Drain the received signal numbers, a burst of signals wakes the loop only once.
+        try:
+            signal_numbers = os.read(read_fd, 64)
+        except BlockingIOError:
+            return
+
+        if shutdown_signals.intersection(signal_numbers):
+            shutdown_event.set()
+
+        other_signal_numbers = bytes(number for number in signal_numbers if number not in shutdown_signals)
+        if other_signal_numbers and previous_wakeup_fd != -1:
+            try:
+                os.write(previous_wakeup_fd, other_signal_numbers)
+            except OSError:
+                pass
 
-async def handle_signal(sig, tgc: TelegramClient, dcl: discord.Client, tasks):
-    """Handle graceful shutdown on received signal."""
-    logger.warning("Received signal %s, shutting down...", {sig})
+    previous_handlers = {sig: signal.signal(sig, lambda *_: None)
+                         for sig in shutdown_signals}
+    previous_wakeup_fd = signal.set_wakeup_fd(write_fd, warn_on_full_buffer=False)
+    event_loop.add_reader(read_fd, on_signal_received)
 
-    # Disconnect clients
-    if tgc.is_connected():
-        tgc.disconnect()
-    if dcl.is_ready():
-        await dcl.close()
+    def restore():
+        event_loop.remove_reader(read_fd)
+        signal.set_wakeup_fd(previous_wakeup_fd)
+        for sig, handler in previous_handlers.items():
+            signal.signal(sig, handler)
+        os.close(read_fd)
+        os.close(write_fd)
 
-    # Cancel all tasks
-    await asyncio.gather(*tasks, return_exceptions=config.app.debug)
+    return restore
 
 
 async def init_clients(dispatcher: EventDispatcher) -> Tuple[TelegramClient, discord.Client]:
     """Handle the initialization of the bridge's clients."""
+    # pylint: disable=import-outside-toplevel
+    from bridge.core import on_restored_connectivity, start
+    from bridge.discord_handler import start_discord
+    from bridge.healtcheck_handler import healthcheck
+    from bridge.telegram_handler import start_telegram_client
+
+    global shutdown_done  # pylint: disable=global-statement
+    shutdown_done = False
 
     lock = asyncio.Lock()
     await lock.acquire()
-    event_loop = asyncio.get_event_loop()
+    event_loop = asyncio.get_running_loop()
 
     telegram_client_instance = await start_telegram_client(config, event_loop)
     discord_client_instance = await start_discord(config)
@@ -278,17 +333,15 @@ async def init_clients(dispatcher: EventDispatcher) -> Tuple[TelegramClient, dis
 
     lock.release()
 
+    shutdown_event = asyncio.Event()
+
     # Set signal handlers for graceful shutdown on received signal (except on Windows)
     # NOTE: This is not supported on Windows
-    if os.name != 'nt' and not config.api.enabled:
-        for sig in (signal.SIGINT, signal.SIGTERM):
-            event_loop.add_signal_handler(
-                sig, lambda sig=sig: asyncio.create_task(shutdown(sig, tasks_loop=event_loop)))  # type: ignore
-    if config.api.enabled:
-        for sig in (signal.SIGINT, signal.SIGTERM):
-            event_loop.add_signal_handler(
-                sig, lambda: asyncio.create_task(on_shutdown(telegram_client_instance, discord_client_instance)))
+    restore_signals = None
+    if os.name != 'nt':
+        restore_signals = set_shutdown_signals(event_loop, shutdown_event)
 
+    workers = []
     try:
         lock = asyncio.Lock()
         await lock.acquire()
@@ -302,6 +355,8 @@ async def init_clients(dispatcher: EventDispatcher) -> Tuple[TelegramClient, dis
         discord_wait_task = event_loop.create_task(
             discord_client_instance.wait_until_ready()
         )
+        # The healthcheck runs even when the API is disabled: the connectivity and health
+        # flags it sets drive the queueing and recovery of the messages in bridge.core.
         api_healthcheck_task = event_loop.create_task(
             healthcheck(dispatcher,
                         telegram_client_instance,
@@ -313,14 +368,33 @@ async def init_clients(dispatcher: EventDispatcher) -> Tuple[TelegramClient, dis
                 telegram_client=telegram_client_instance,
                 discord_client=discord_client_instance)
         )
+        shutdown_wait_task = event_loop.create_task(shutdown_event.wait())
+        workers = [start_task,
+                   telegram_wait_task,
+                   discord_wait_task,
+                   api_healthcheck_task,
+                   on_restored_connectivity_task,
+                   shutdown_wait_task]
         lock.release()
 
-        await asyncio.gather(start_task,
-                             telegram_wait_task,
-                             discord_wait_task,
-                             api_healthcheck_task,
-                             on_restored_connectivity_task, return_exceptions=config.app.debug)
+        # `start` and `wait_until_ready` return once the bridge is up, the bridge keeps running
+        # until one of them fails, Telegram disconnects, one of the background loops ends,
+        # or a shutdown is requested.
+        startup_tasks = {start_task, discord_wait_task}
+        pending = set(workers)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+            if any(not task.cancelled() and task.exception() is not None for task in done & startup_tasks):
+                # The error itself is logged by on_shutdown.
+                logger.error("The %s failed to start, shutting down...", config.app.name)
+                break
 
+            if done - startup_tasks:
+                break
+
+        if shutdown_wait_task.done():
+            logger.warning("Received a shutdown signal, shutting down...")
 
     except asyncio.CancelledError as ex:
         logger.warning(
@@ -329,72 +403,13 @@ async def init_clients(dispatcher: EventDispatcher) -> Tuple[TelegramClient, dis
         logger.error("Error while running the bridge: %s",
                      ex, exc_info=config.app.debug)
     finally:
-        await on_shutdown(telegram_client_instance, discord_client_instance)
+        await on_shutdown(telegram_client_instance, discord_client_instance, workers)
+        if restore_signals is not None:
+            restore_signals()
 
     return telegram_client_instance, discord_client_instance
 
 
-def start_bridge(dispatcher: EventDispatcher):
-    """Start the bridge."""
-
-    logger.info("Starting %s...", config.app.name)
-
-    event_loop = asyncio.get_event_loop()
-
-    event_loop.set_debug(config.app.debug)
-    # Set the exception handler.
-    event_loop.set_exception_handler(event_loop_exception_handler)
-
-    # Create a PID file.
-    pid_file = create_pid_file()
-
-    # Create a task for the main coroutine.
-    main_task = event_loop.create_task(main(dispatcher=dispatcher))
-
-    try:
-        if event_loop.is_running():
-            logger.warning("Event loop is already running, not starting a new one.")
-            main_task.done()
-        else:
-            # Run the event loop.
-            event_loop.run_forever()
-    except KeyboardInterrupt:
-        # Cancel the main task.
-        main_task.cancel()
-    except asyncio.CancelledError:
-        pass
-    except asyncio.LimitOverrunError as ex:
-        logger.error(
-            "The event loop has exceeded the configured limit of pending tasks: %s",
-            ex, exc_info=config.app.debug)
-    except Exception as ex:  # pylint: disable=broad-except
-        logger.error("Error while running the bridge: %s",
-                     ex, exc_info=config.app.debug)
-    finally:
-        # Remove the PID file.
-        if not config.api.enabled:
-            remove_pid_file(pid_file)
-
-
-def event_loop_exception_handler(event_loop: AbstractEventLoop | None, context):
-    """Asyncio Event loop exception handler."""
-    if event_loop is None:
-        event_loop = asyncio.get_event_loop()
-    try:
-        exception = context.get("exception")
-        if not isinstance(exception, asyncio.CancelledError):
-            event_loop.default_exception_handler(context)
-        else:
-            # This error is expected during shutdown.
-            logger.warning("CancelledError caught during shutdown")
-    except Exception as ex:  # pylint: disable=broad-except
-        logger.error(
-            "Event loop exception handler failed: %s",
-            ex,
-            exc_info=config.app.debug,
-        )
-
-
 def daemonize_process():
     """Daemonize the process by forking and redirecting standard file descriptors."""
     # Fork the process and exit if we're the parent
@@ -411,18 +426,22 @@ def daemonize_process():
         sys.exit()
 
     # Redirect standard file descriptors to /dev/null
-    with open(os.devnull, "r", encoding="utf-8") as devnull:
-        os.dup2(devnull.fileno(), sys.stdin.fileno())
-    with open(os.devnull, "w", encoding="utf-8") as devnull:
-        os.dup2(devnull.fileno(), sys.stdout.fileno())
-        os.dup2(devnull.fileno(), sys.stderr.fileno())
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for std_stream in (sys.stdin, sys.stdout, sys.stderr):
+        os.dup2(devnull, std_stream.fileno())
+    os.close(devnull)
 
 
 async def main(dispatcher: EventDispatcher):
     """Run the bridge."""
-    clients = ()
+    logger.info("Starting %s...", config.app.name)
+
+    # Create a PID file.
+    pid_file = create_pid_file()
+
     try:
-        clients = await init_clients(dispatcher=dispatcher)
+        # init_clients shuts the clients down before returning.
+        await init_clients(dispatcher=dispatcher)
     except KeyboardInterrupt:
         logger.warning("Interrupted by user, shutting down...")
     except asyncio.CancelledError:
@@ -432,17 +451,11 @@ async def main(dispatcher: EventDispatcher):
     except OperationalError as ex:
         logger.error("OperationalError caught: %s", ex, exc_info=config.app.debug)
     finally:
-        if clients:
-            telegram_client, discord_client = clients[0], clients[1]
-            if telegram_client and not telegram_client.is_connected() and not discord_client.is_ready():
-                clients = ()
-            else:
-                await on_shutdown(telegram_client, discord_client)
-                clients = ()
+        # Remove the PID file.
+        remove_pid_file(pid_file)
 
 
 async def run_controller(dispatcher: EventDispatcher | None,
-                     event_loop: AbstractEventLoop | None = None,
                      boot: bool = False,
                      stop: bool = False,
                      background: bool = False):
@@ -477,19 +490,11 @@ async def run_controller(dispatcher: EventDispatcher | None,
             logger.info("Starting %s in the background...", config.app.name)
             daemonize_process()
 
-        if event_loop is None:
-            try:
-                event_loop = asyncio.get_event_loop()
-            except RuntimeError:
-                logger.warning("No event loop found, creating a new one")
-                event_loop = asyncio.new_event_loop()
-
-        asyncio.set_event_loop(event_loop)
-
         if dispatcher is None:
             dispatcher = EventDispatcher()
 
-        start_bridge(dispatcher=dispatcher)
+        # The API server's event loop is already running, the bridge runs on it.
+        await main(dispatcher=dispatcher)
     elif stop:
         stop_bridge()
     else:
@@ -497,7 +502,6 @@ async def run_controller(dispatcher: EventDispatcher | None,
 
 
 def controller(dispatcher: EventDispatcher | None,
-                     event_loop: AbstractEventLoop | None = None,
                      boot: bool = False,
                      stop: bool = False,
                      background: bool = False):
@@ -526,19 +530,13 @@ def controller(dispatcher: EventDispatcher | None,
             logger.info("Starting %s in the background...", config.app.name)
             daemonize_process()
 
-        if event_loop is None:
-            try:
-                event_loop = asyncio.get_event_loop()
-            except RuntimeError:
-                logger.warning("No event loop found, creating a new one")
-                event_loop = asyncio.new_event_loop()
-
-            asyncio.set_event_loop(event_loop)
-
         if dispatcher is None:
             dispatcher = EventDispatcher()
 
-        start_bridge(dispatcher=dispatcher)
+        try:
+            asyncio.run(main(dispatcher=dispatcher), debug=config.app.debug)
+        except KeyboardInterrupt:
+            logger.warning("Interrupted by user, shutting down...")
     elif stop:
         stop_bridge()
     else:
@@ -578,4 +576,4 @@ if __name__ == "__main__":
 
     event_dispatcher = EventDispatcher()
 
-    controller(dispatcher=event_dispatcher, event_loop=asyncio.new_event_loop() ,boot=__start, stop=__stop, background=__background)
+    controller(dispatcher=event_dispatcher, boot=__start, stop=__stop, background=__background)